@@ -20,7 +20,8 @@ autodoc_mock_imports = [
     "numpy",
     "scipy",
     "pandas",
-    "sympy"
+    "sympy",
+    "numba"
 ]
 
 # -- Project information -----------------------------------------------------
@@ -40,6 +40,6 @@ setup(name='ttv2fast2furious',
     ],
     keywords='astronomy astrophysics',
     packages=['ttv2fast2furious'],
-    install_requires=['numpy', 'scipy','sympy','pandas'],
+    install_requires=['numpy', 'scipy','sympy','pandas','numba'],
     include_package_data=True,
     zip_safe=False)
@@ -0,0 +1,32 @@
+"""
+Compile the q(m) kernel in :mod:`ttv2fast2furious._kernels` ahead of time.
+
+Running::
+
+    python -m ttv2fast2furious._compile_kernels
+
+builds the extension module ``_limit_kernels`` next to this file. When it
+is present and was built from the current ``_kernels.py``,
+:mod:`ttv2fast2furious.companion_limits` uses it instead of JIT-compiling
+the kernel on first use.
+
+The phase-fit kernel is not exported: pycc cannot compile its parallel
+loop over phases, so it is always JIT-compiled with ``parallel=True``.
+"""
+import os
+from numba.pycc import CC
+from ttv2fast2furious import _kernels
+
+cc = CC('_limit_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+_CHECKSUM = _kernels.source_checksum()
+
+def kernels_checksum():
+    return _CHECKSUM
+
+cc.export('kernels_checksum','i8()')(kernels_checksum)
+cc.export('q_of_mup','f8[::1](f8[::1],f8[::1],f8[::1],f8[::1],f8[::1])')(_kernels.q_of_mup)
+
+if __name__ == '__main__':
+    cc.compile()
@@ -0,0 +1,112 @@
+"""
+Numerical kernels used by :mod:`ttv2fast2furious.companion_limits`.
+
+The functions are written in plain python and JIT-compiled with numba
+the first time they are called. ``fit_all_phases`` is always JIT-compiled
+so that it runs in parallel over phases; ``q_of_mup`` can instead be
+compiled ahead of time into an extension module with ``_compile_kernels.py``.
+"""
+import math
+import zlib
+import numpy as np
+from numba import prange
+
+def source_checksum():
+    """
+    Return the CRC32 checksum of this file, used to detect an ahead-of-time
+    compiled kernel module built from an older version of these kernels.
+    """
+    with open(__file__,'rb') as f:
+        return zlib.crc32(f.read())
+
+def fit_all_phases(dt0_basis_fns,idx,unc,yvec,mbest,sigma,chisq):
+    """
+    Fit constant, linear, and TTV basis functions to the weighted transit timing
+    residuals `yvec` for each row of TTV basis function values in `dt0_basis_fns`,
+    in parallel. `yvec` should be measured from a linear ephemeris close to the
+    best fit, otherwise the sums below lose precision to cancellation.
+
+    The best-fit mass, mass distribution 'sigma' and chi-squared of each
+    row are stored in `mbest`, `sigma` and `chisq`. The linear ephemeris is
+    fit once, and each TTV basis function is then fit to its residuals using
+    the last row of a 3x3 Cholesky factorization of the normal equations.
+    Where the best-fit mass is negative, the constrained best fit is the
+    linear ephemeris.
+    """
+    Ndata = idx.size
+
+    # Gram matrix and right-hand side entries of the linear ephemeris basis functions
+    g00 = 0.
+    g01 = 0.
+    g11 = 0.
+    r0 = 0.
+    r1 = 0.
+    for k in range(Ndata):
+        d0 = 1.0 / unc[k]
+        d1 = idx[k] * d0
+        g00 += d0 * d0
+        g01 += d0 * d1
+        g11 += d1 * d1
+        r0 += d0 * yvec[k]
+        r1 += d1 * yvec[k]
+    l00 = math.sqrt(g00)
+    l10 = g01 / l00
+    l11 = math.sqrt(g11 - l10 * l10)
+    z0 = r0 / l00
+    z1 = (r1 - l10 * z0) / l11
+
+    # Residuals and chi-squared of the linear ephemeris fit
+    b1 = z1 / l11
+    b0 = (z0 - l10 * b1) / l00
+    res_lin = np.empty(Ndata)
+    chisq_lin = 0.
+    for k in range(Ndata):
+        res_lin[k] = yvec[k] - (b0 + b1 * idx[k]) / unc[k]
+        chisq_lin += res_lin[k] * res_lin[k]
+
+    for p in prange(dt0_basis_fns.shape[0]):
+        g02 = 0.
+        g12 = 0.
+        g22 = 0.
+        c = 0.
+        for k in range(Ndata):
+            d0 = 1.0 / unc[k]
+            d2 = dt0_basis_fns[p,idx[k]] * d0
+            g02 += d0 * d2
+            g12 += idx[k] * d0 * d2
+            g22 += d2 * d2
+            c += d2 * res_lin[k]
+
+        # Complete the Cholesky factorization. l22^2 is the squared norm of the
+        # TTV basis function after projecting out the linear basis functions.
+        l20 = g02 / l00
+        l21 = (g12 - l20 * l10) / l11
+        l22 = math.sqrt(g22 - l20 * l20 - l21 * l21)
+        sigma[p] = 1.0 / l22
+
+        # The best-fit mass is c / l22^2, so its sign is that of the overlap c
+        # between the TTV basis function and the linear fit residuals.
+        if c <= 0:
+            mbest[p] = 0.
+            chisq[p] = chisq_lin
+        else:
+            mbest[p] = c / (l22 * l22)
+            chisq[p] = chisq_lin - c * mbest[p]
+
+def q_of_mup(mups,mbest,inv_scale,a,wq):
+    """
+    Evaluate q(m) at each of the mass upper limits `mups` by integrating
+    :func:`~ttv2fast2furious.companion_limits.q_integrand` over phase with the trapezoidal rule.
+
+    The phase-independent quantities inv_scale = 1 / (sigma * sqrt(2)) and
+    a = erf(mbest * inv_scale) are precomputed by the caller, along with the
+    weights wq, which combine the trapezoidal rule weights, the normalized
+    phase weights exp(-dchisq/2), and the integrand's denominator 1 + a.
+    """
+    q = np.empty(mups.size)
+    for j in range(mups.size):
+        acc = 0.
+        for i in range(mbest.size):
+            acc += wq[i] * (a[i] + math.erf((mups[j] - mbest[i]) * inv_scale[i]))
+        q[j] = acc
+    return q
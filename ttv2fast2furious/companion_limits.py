@@ -1,11 +1,32 @@
 """Module for computing upper limits on the mass of any unseen companions to an observed singly-transiting planet."""
+import warnings
 import numpy as np
-from scipy.optimize import brenth,nnls
 from scipy.special import erf
-from scipy.optimize import minimize,LinearConstraint
-from scipy.integrate import trapz
+from scipy.linalg import cho_factor,cho_solve
+from numba import njit
 from .ttv_basis_functions import dt0_InnerPlanet,dt0_OuterPlanet
+from .ttv_basis_functions import dt0_InnerPlanet_batch,dt0_OuterPlanet_batch
 from .ttv2fast2furious import PlanetTransitObservations
+from . import _kernels
+
+# The phase fit is always JIT-compiled since it runs in parallel over phases
+_fit_all_phases = njit(parallel=True,cache=True)(_kernels.fit_all_phases)
+
+try:
+    # q(m) kernel compiled ahead of time by running _compile_kernels.py
+    from . import _limit_kernels
+except ImportError:
+    _limit_kernels = None
+
+_aot_checksum = getattr(_limit_kernels,'kernels_checksum',None)
+if _aot_checksum is not None and _aot_checksum() == _kernels.source_checksum():
+    _q_of_mup_fast = _limit_kernels.q_of_mup
+else:
+    if _limit_kernels is not None:
+        warnings.warn("Ignoring out-of-date '_limit_kernels' module. Rebuild it with 'python -m ttv2fast2furious._compile_kernels'.")
+    _q_of_mup_fast = njit(cache=True,fastmath=True)(_kernels.q_of_mup)
+
+_SQRT2 = np.sqrt(2)
 
 def PerturberPeriodPhaseToBestSigmaChiSquared(Ppert,phi,TransitObservations, PlanetData = None,full_output=False):
     """
@@ -38,10 +59,8 @@ def PerturberPeriodPhaseToBestSigmaChiSquared(Ppert,phi,TransitObservations, Pla
     transit_time = TransitObservations.times
     transit_unc = TransitObservations.uncertainties
 
-    assert np.alltrue(transit_num>=0), " 'TransitObservations' contains transits with negative transit numbers. Please re-number transits." 
-    assert np.alltrue(transit_time>0), " 'TransitObservations' contains transits with negative transit time. Negative transit times are not supported since a non-negative least squares algorithm is used to determine the best-fit basis function amplitudes." 
+    assert np.all(transit_num>=0), " 'TransitObservations' contains transits with negative transit numbers. Please re-number transits." 
 
-    yvec = transit_time / transit_unc
     Ntransits = int(np.max(transit_num))
     Tpert = Ppert * phi / (2*np.pi)
 
@@ -52,25 +71,94 @@ def PerturberPeriodPhaseToBestSigmaChiSquared(Ppert,phi,TransitObservations, Pla
     else:
         T0,P = PlanetData
 
+    # Fit the residuals from the linear ephemeris T0 + P*n so that the large
+    # transit times cancel before the normal equations are formed.
+    yvec = (transit_time - T0 - P * transit_num) / transit_unc
+
     if Ppert > P:
         dt0_basis_fn = dt0_InnerPlanet(P,Ppert,T0,Tpert,Ntransits+1)
     else:
         dt0_basis_fn = dt0_OuterPlanet(P,Ppert,T0,Tpert,Ntransits+1)
 
-    bfMatrix = np.vstack([np.ones(Ntransits+1) , np.arange(Ntransits+1) , dt0_basis_fn]).T
+    bfMatrix = np.empty((Ntransits+1,3))
+    bfMatrix[:,0] = 1.
+    bfMatrix[:,1] = np.arange(Ntransits+1)
+    bfMatrix[:,2] = dt0_basis_fn
 
-    design_Matrix = np.array([bfMatrix[i]/transit_unc[ni]  for ni,i in enumerate(np.array(transit_num,dtype=int))])
+    design_Matrix = bfMatrix[transit_num.astype(np.intp)] / transit_unc[:,None]
 
-    Sigma_matrix = np.linalg.inv(design_Matrix.T.dot(design_Matrix))
-    # New method for obtaining best fit using scipy's 'nnls' algorithm
-    # Use of this algorithm requires all transit times to be non-negative 
-    best,chisq = nnls(design_Matrix,yvec)
+    # Factor the Gram matrix once and use it for both the best fit and the covariance
+    G = design_Matrix.T.dot(design_Matrix)
+    cho = cho_factor(G,lower=True,check_finite=False)
+    best = cho_solve(cho,design_Matrix.T.dot(yvec),check_finite=False)
+    Sigma_matrix = cho_solve(cho,np.eye(3),check_finite=False)
+    resid = design_Matrix.dot(best) - yvec
+    chisq = resid.dot(resid)
+    if best[2] < 0:
+        # With the mass amplitude held at zero, the constrained best fit is
+        # the least-squares fit of the two remaining basis functions.
+        D12 = design_Matrix[:,:2]
+        cho12 = cho_factor(D12.T.dot(D12),lower=True,check_finite=False)
+        best12 = cho_solve(cho12,D12.T.dot(yvec),check_finite=False)
+        best = np.array([best12[0],best12[1],0.])
+        resid = design_Matrix.dot(best) - yvec
+        chisq = resid.dot(resid)
 
     if full_output:
-        return best[2], np.sqrt(Sigma_matrix[2,2]) ,chisq ,dict({'BestFit':best,'CovarianceMatrix':Sigma_matrix,'DesignMatrix':design_Matrix,'WeightedObsVec':yvec,'BasisFunctionMatrix':bfMatrix})
+        best_full = best + np.array([T0,P,0.])
+        return best[2], np.sqrt(Sigma_matrix[2,2]) ,chisq ,dict({'BestFit':best_full,'CovarianceMatrix':Sigma_matrix,'DesignMatrix':design_Matrix,'WeightedObsVec':transit_time / transit_unc,'BasisFunctionMatrix':bfMatrix})
 
     return best[2], np.sqrt(Sigma_matrix[2,2]) ,chisq
 
+def _batch_perturber_fit(Ppert,phases,T0,P,transit_num_int,transit_unc,yvec):
+    """
+    Vectorized version of :func:`PerturberPeriodPhaseToBestSigmaChiSquared` that
+    fits every perturber phase at once.
+
+    Parameters
+    ----------
+    Ppert : real
+        Period of the pertuber
+    phases : ndarray
+        Orbital phases of perturber
+    T0 : real
+        Transiting planet's time of initial transit.
+    P : real
+        Transiting planet's period.
+    transit_num_int : ndarray of ints
+        Non-negative transit numbers of the observed transits.
+    transit_unc : ndarray
+        Transit mid-time uncertainties.
+    yvec : ndarray
+        Residuals of the transit mid-times from the linear ephemeris
+        T0 + P * n, weighted by their uncertainties.
+
+    Returns
+    -------
+    mbest : ndarray, shape (Nphi,)
+        Best-fit mass at each phase.
+    sigma : ndarray, shape (Nphi,)
+        Mass distribution 'sigma' at each phase.
+    chisq : ndarray, shape (Nphi,)
+        Chi-squared of the timing residuals at each phase.
+    """
+
+    Ntransits = int(np.max(transit_num_int))
+    Tperts = Ppert * np.asarray(phases) / (2*np.pi)
+    Nphi = len(Tperts)
+
+    if Ppert > P:
+        dt0_basis_fns = dt0_InnerPlanet_batch(P,Ppert,T0,Tperts,Ntransits+1)
+    else:
+        dt0_basis_fns = dt0_OuterPlanet_batch(P,Ppert,T0,Tperts,Ntransits+1)
+
+    mbest = np.empty(Nphi)
+    sigma = np.empty(Nphi)
+    chisq = np.empty(Nphi)
+    _fit_all_phases(dt0_basis_fns,transit_num_int,transit_unc,yvec,mbest,sigma,chisq)
+
+    return mbest,sigma,chisq
+
 def q_integrand(mup,mbest,sigma):
     """
     Compute the value of the integrand in the integral over phase that determines q(m).
@@ -95,7 +183,79 @@ def q_integrand(mup,mbest,sigma):
     denom = 1 + erf(mbest / sigma / np.sqrt(2))
     return num / denom
 
-def UnseenPerturberMassUpperLimit(Ppert,confidence_levels,TransitObservations ,Nphi = 50,Mmax0 = 3e-3,PlanetData = None):
+def _chandrupatla(f,y,a,b,xtol=2e-12,rtol=4*np.finfo(float).eps,maxiter=100):
+    """
+    Solve f(x) = y for every target value in `y` with Chandrupatla's method.
+
+    All roots are found in lockstep so that each call to the vectorized,
+    monotonically increasing function `f` is shared between them.
+
+    Arguments
+    ---------
+    f : callable
+        Function mapping an array of x values to an array of f(x) values.
+    y : array-like
+        Target values.
+    a, b : real
+        Bracket satisfying f(a) <= y <= f(b) for every target value.
+    xtol, rtol : real (optional)
+        Absolute and relative tolerance of the roots.
+    maxiter : int (optional)
+        Maximum number of iterations. A RuntimeError is raised if any root
+        has not converged after this many iterations.
+
+    Returns
+    -------
+    ndarray :
+        The roots, one for each target value.
+    """
+    y = np.asarray(y,dtype=float)
+    a = np.full(y.shape,a,dtype=float)
+    b = np.full(y.shape,b,dtype=float)
+    fa = f(a) - y
+    fb = f(b) - y
+    if not (np.all(np.isfinite(fa)) and np.all(np.isfinite(fb))):
+        raise ValueError("Function values at the bracket endpoints must be finite.")
+    if np.any(fa * fb > 0):
+        raise ValueError("Every target value must be bracketed by f(a) and f(b).")
+    c,fc = a.copy(),fa.copy()
+    t = np.full(y.shape,0.5)
+    roots = np.where(np.abs(fa) < np.abs(fb),a,b)
+    active = (fa != 0) & (fb != 0)
+    for _ in range(maxiter):
+        if not np.any(active):
+            break
+        xt = a + t * (b - a)
+        ft = np.zeros(y.shape)
+        ft[active] = f(xt[active]) - y[active]
+        # Keep the root bracketed by [a,b]; c holds the previous endpoint
+        flip = active & (np.sign(ft) != np.sign(fa))
+        keep = active & ~flip
+        c[flip],fc[flip] = b[flip],fb[flip]
+        b[flip],fb[flip] = a[flip],fa[flip]
+        c[keep],fc[keep] = a[keep],fa[keep]
+        a[active],fa[active] = xt[active],ft[active]
+
+        use_a = np.abs(fa) < np.abs(fb)
+        xm = np.where(use_a,a,b)
+        fm = np.where(use_a,fa,fb)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            tlim = (rtol * np.abs(xm) + xtol) / np.abs(b - c)
+            done = active & ((tlim > 0.5) | (fm == 0))
+            roots[done] = xm[done]
+            active &= ~done
+            # Use inverse quadratic interpolation when it is safe, bisection otherwise
+            xi = (a - b) / (c - b)
+            phi = (fa - fb) / (fc - fb)
+            iqi = (phi * phi < xi) & ((1 - phi) * (1 - phi) < 1 - xi)
+            t_iqi = fa / (fb - fa) * fc / (fb - fc) + (c - a) / (b - a) * fa / (fc - fa) * fb / (fc - fb)
+            t = np.where(iqi,t_iqi,0.5)
+            t = np.minimum(np.maximum(t,tlim),1 - tlim)
+    if np.any(active):
+        raise RuntimeError("Failed to converge after %d iterations."%maxiter)
+    return roots
+
+def UnseenPerturberMassUpperLimit(Ppert,confidence_levels,TransitObservations ,Nphi = 50,Mmax0 = 3e-3,PlanetData = None,rtol = 1e-6):
     """
     Compute mass upper limit(s) on a potential perturber at a given orbital period using transit data.
     Marginalizes over possible orbital phases of the perturber.
@@ -119,6 +279,9 @@ def UnseenPerturberMassUpperLimit(Ppert,confidence_levels,TransitObservations ,N
         List containing [T0,P] where T0 is the initial transit time and P is period 
          of the traniting planet. If these values are not supplied they are computed
          from the transit data.
+    rtol : real (optional)
+        Relative tolerance to which the mass upper limits are computed.
+        Default value is rtol=1e-6.
     Returns
     -------
     limits : array-like
@@ -127,17 +290,47 @@ def UnseenPerturberMassUpperLimit(Ppert,confidence_levels,TransitObservations ,N
 
 
 
+    # Observation arrays are extracted and the transit numbers cast once
+    transit_num_int = np.ascontiguousarray(TransitObservations.transit_numbers,dtype=np.int64)
+    transit_unc = np.ascontiguousarray(TransitObservations.uncertainties,dtype=float)
+
+    assert np.all(transit_num_int>=0), " 'TransitObservations' contains transits with negative transit numbers. Please re-number transits." 
+
+    if PlanetData is None:
+        PlanetData = TransitObservations.linear_best_fit()
+    T0,P = PlanetData
+
+    # Fit the residuals from the linear ephemeris so that the large transit
+    # times cancel before the normal equations are formed.
+    yvec = (TransitObservations.times - T0 - P * transit_num_int) / transit_unc
+
     phases = np.linspace(-np.pi,np.pi,Nphi)
-    mbest,sigma,chisq = np.array([PerturberPeriodPhaseToBestSigmaChiSquared(Ppert,phase,TransitObservations,PlanetData=PlanetData) for phase in phases]).T
-    dchisq = chisq - np.mean(chisq)
-    q_of_mup = lambda mup: trapz( q_integrand(mup,mbest,sigma) * np.exp(-0.5 * dchisq),phases) / trapz(np.exp(-0.5 * dchisq),phases)
+    mbest,sigma,chisq = _batch_perturber_fit(Ppert,phases,T0,P,transit_num_int,transit_unc,yvec)
+    # Offset by the minimum so the largest phase weight is exp(0) = 1 and
+    # exp(-dchisq/2) cannot overflow; the weights are normalized below.
+    dchisq = chisq - np.min(chisq)
+    # Quantities that do not depend on the mass upper limit are computed once
+    inv_scale = 1 / (sigma * _SQRT2)
+    a = erf(mbest * inv_scale)
+    dphi = phases[1] - phases[0]
+    wtrap = dphi * np.ones(Nphi)
+    wtrap[0] *= 0.5
+    wtrap[-1] *= 0.5
+    w = np.exp(-0.5 * dchisq) * wtrap
+    wq = w / w.sum() / (1 + a)
+    if not np.all(np.isfinite(wq)):
+        raise ValueError("Non-finite phase weights encountered for perturber period %g."%Ppert)
+    q_of_mup = lambda mups: _q_of_mup_fast(mups,mbest,inv_scale,a,wq)
 
-    mups = []
+    cls = np.atleast_1d(confidence_levels)
+    for cl in cls:
+        assert (0 < cl < 1), "%.2f is not a valid confidence level between 0 and 1!"%cl
 
-    for cl in np.atleast_1d(confidence_levels):
-        assert (cl < 1), "%.2f is not a valid confidence level between 0 and 1!"%cl
-        while q_of_mup(Mmax0) - cl < 0:
-            Mmax0 *=2
-        mups.append(brenth(lambda x: q_of_mup(x) - cl,0,Mmax0))
+    # q(m) increases monotonically from q(0) = 0, so a single bracket
+    # [0,Mmax0] can be shared by all confidence levels.
+    while q_of_mup(np.array([Mmax0]))[0] < np.max(cls):
+        Mmax0 *=2
 
-    return np.array(mups)
+    # The limits are only needed to a fixed fractional precision, whatever the
+    # perturber mass scale, so no absolute tolerance is used.
+    return _chandrupatla(q_of_mup,cls,0.,Mmax0,xtol=0.,rtol=rtol)
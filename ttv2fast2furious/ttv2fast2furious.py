@@ -458,7 +458,7 @@ class TransitTimesLinearModels(object):
         self.observations=observations_list
         for obs in self.observations:
             errmsg1 = "'TransitObservations' contains transits with negative transit numbers. Please re-number transits." 
-            assert np.alltrue(obs.transit_numbers>=0), errmsg1
+            assert np.all(obs.transit_numbers>=0), errmsg1
 
         initial_linear_fit_data = np.array([obs.linear_best_fit() for obs in self.observations ])
         self.T0s = initial_linear_fit_data[:,0]
@@ -155,6 +155,12 @@ def dz1Im(alpha,n1t,n1t0=0,psi0=0,l10=0):
     I = integrate.quad( integrand1_im , n1t0 , n1t , args=(alpha,psi0,l10) )[0]
     return  I
 
+# integrate fn(t,*args) over each of the intervals [t0,t1] with a single call to quad_vec
+def interval_integrals(fn,t0,t1,*args):
+    dt = t1 - t0
+    I = integrate.quad_vec( lambda u: fn(t0 + u * dt,*args) * dt , 0 , 1 )[0]
+    return I
+
 ########################################
 ########## ttv basis functions #########
 ########################################
@@ -270,6 +276,103 @@ def dt0_OuterPlanet(P,P1,T0,T10,Ntrans):
     ttv = -1 * P1 *  (-dl1A - 2 * dz1) / (2*np.pi)
     return ttv
 ########################################
+def dt0_InnerPlanet_batch(P,P1,T0,T10s,Ntrans):
+    """
+    Compute the 0th order (in eccentricity) TTV basis function for an 
+    inner planet with exterior perturber for a sequence of perturber
+    initial transit times.
+
+    Arguments
+    ---------
+        P : real
+            The period of the planet
+        P1 : real
+            The period of the perturber
+        T0 :  real
+            Planet's time of initial transit
+        T10s : ndarray
+            Perturber's times of initial transit
+        Ntrans : int
+            Number of transits to compute
+
+    Returns
+    -------
+
+        ndarray :
+            Array of shape (len(T10s),Ntrans) containing the basis function
+            values at sequential transit times for each perturber initial transit time.
+    """
+
+    # compute mean longitudes and synodic angle
+    l = 2*np.pi * -T0 / P
+    l1= 2*np.pi * -np.asarray(T10s)[:,None] / P1
+
+    psi0=np.mod(l1-l ,2*np.pi)
+    
+    # get the unperturbed transit times
+    TransitTimes0=getTimesOfTransit(P,l,Ntrans)
+    TransitPhases0=2*np.pi * TransitTimes0 / P
+
+    # get psi at the unperturbed transit times (i.e., when l=0)
+    psi = np.mod(l1 + 2 * np.pi * TransitTimes0 / P1,2*np.pi)
+
+    #get semi-major axis ratio
+    alpha = np.power(P/P1,2./3.)
+    
+    # get list of delta-lambdas
+    dl = dlFn(alpha,psi) 
+    
+    # get list of delta-z, integrating between successive transits
+    TransitPhasesLast = np.append(0.,TransitPhases0[:-1])
+    dzImArr = np.cumsum(interval_integrals(integrand_im,TransitPhasesLast,TransitPhases0,alpha,psi0,l),axis=1)
+
+    dl = dl-np.mean(dl,axis=1,keepdims=True)
+    dzImArr = dzImArr-np.mean(dzImArr,axis=1,keepdims=True)
+    dz = dzImArr
+    ttv0 = -1 * P *  (dl - 2 * dz) / (2*np.pi)
+    return ttv0
+########################################
+def dt0_OuterPlanet_batch(P,P1,T0,T10s,Ntrans):
+    """
+    Compute the 0th order (in eccentricity) TTV basis function for an 
+    outer planet with interior perturber for a sequence of perturber
+    initial transit times.
+
+    Arguments are the same as :func:`dt0_InnerPlanet_batch`.
+    """
+
+    # compute mean longitudes and synodic angle
+    l = 2*np.pi * -T0 / P
+    l1= 2*np.pi * -np.asarray(T10s)[:,None] / P1
+
+    psi0=np.mod(l1-l ,2*np.pi)
+    
+    # get the unperturbed transit times
+    TransitTimes0=getTimesOfTransit(P1,l1,Ntrans)
+    TransitPhases0=2*np.pi * TransitTimes0 / P1
+
+    # get psi at the unperturbed transit times (i.e., when l1=0)
+    psi = np.mod(l + 2 * np.pi * TransitTimes0 / P,2*np.pi)
+
+    #get semi-major axis ratio
+    alpha = np.power(P/P1,2./3.)
+    
+    # get list of delta-lambdas
+    dl1A = dl1Fn(alpha,psi)
+
+    # get list of delta-z, integrating between successive transits.
+    # As in dt0_OuterPlanet, the first interval is integrated with l10=l.
+    TransitPhasesLast = np.hstack((np.zeros_like(l1),TransitPhases0[:,:-1]))
+    l10 = np.repeat(l1,Ntrans,axis=1)
+    l10[:,0] = l
+    dz1ImArr = np.cumsum(interval_integrals(integrand1_im,TransitPhasesLast,TransitPhases0,alpha,psi0,l10),axis=1)
+
+    dl1A = dl1A-np.mean(dl1A,axis=1,keepdims=True)
+    dz1ImArr = dz1ImArr-np.mean(dz1ImArr,axis=1,keepdims=True)
+    dz1 = dz1ImArr
+    ttv = -1 * P1 *  (-dl1A - 2 * dz1) / (2*np.pi)
+    return ttv
+########################################
 
 def get_nearest_firstorder(periodratio):
     return int(np.round((1-periodratio)**(-1)))